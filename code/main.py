@@ -4,15 +4,21 @@ This script monitors for nuclear events and uploads data to GitHub.
 It handles NED (Nuclear Event Detection) interrupts and periodic status updates.
 """
 
+import array
+import errno
+import gc
 import json
 import machine  # For device reset
+import micropython
 import network
 import secrets  # Import Wi-Fi and GitHub credentials, device paramaters
+import select
 import socket
+import ssl
 import struct
 import time
 import ubinascii
-import urequests
+import urandom
 
 #######################
 # Hardware Configuration
@@ -22,22 +28,73 @@ import urequests
 LED_W = machine.Pin(2, machine.Pin.OUT)  # White LED - WiFi Status
 LED_G = machine.Pin(6, machine.Pin.OUT)  # Green LED - BIST Status
 LED_R = machine.Pin(11, machine.Pin.OUT) # Red LED - Error/NED Status
+LEDS = (LED_W, LED_R, LED_G)             # All LEDs, for flashing together
 
 # Input/Output Pins
 BIST_EN = machine.Pin(12, machine.Pin.IN)   # BIST Enable Input
 NED_OUT = machine.Pin(18, machine.Pin.IN)   # Nuclear Event Detection Input
 BIST_OUT = machine.Pin(14, machine.Pin.OUT) # BIST Output Signal
 
+# Reserve memory for tracebacks raised inside interrupt handlers
+micropython.alloc_emergency_exception_buf(100)
+
 # Initialize Hardware States
 BIST_OUT.on()
-NED_EVENT = 0  # Nuclear Event Detection Flag
-BIST_ENABLED = False  # BIST flag
+# Flags shared with the interrupt handlers are single-element int arrays so
+# that setting and clearing them is one non-allocating store
+_NED_FLAG = array.array('i', [0])   # Nuclear Event Detection Flag, 1 new event, 2 upload retry
+_BIST_FLAG = array.array('i', [0])  # BIST flag
+NED_TICKS = 0  # ticks_ms() captured when the NED interrupt fired
 
 #######################
 # Network Configuration
 #######################
 
+WLAN = network.WLAN(network.STA_IF)  # Station interface, reused across reconnects
+
+FLUSH_EVERY = 10  # Upload status every N monitored minutes
+INITIAL_INTERVAL = 500  # Base retry backoff in ms
+BACKOFF_CUTOFF = 8000   # Maximum retry backoff in ms
 NTP_SERVER = "pool.ntp.org"  # NTP server for time synchronization
+_NTP_QUERY = b'\x1b' + 47 * b'\0'  # NTP v3 client request packet
+_NTP_ADDR = None  # Resolved NTP server address, cached between calls
+NTP_TIMEOUT = 5000  # NTP response timeout in ms
+
+# GitHub API location and headers for the data file, built once at import
+GITHUB_HOST = "api.github.com"
+GITHUB_PATH = f"/repos/{secrets.GITHUB_USER}/{secrets.REPO_NAME}/contents/{secrets.FILE_PATH}"
+_GITHUB_ADDR = None  # Resolved GitHub API address, cached between calls
+HTTP_TIMEOUT = 10000  # GitHub connect and response timeout in ms
+GITHUB_AUTH = "token " + secrets.GITHUB_TOKEN
+USER_AGENT = "BhangmeterV2." + secrets.STATION
+GET_HEADERS = {
+    "Authorization": GITHUB_AUTH,
+    "User-Agent": USER_AGENT
+}
+PUT_HEADERS = {
+    "Authorization": GITHUB_AUTH,
+    "Content-Type": "application/json",
+    "User-Agent": USER_AGENT
+}
+
+# JSON data file contents, filled by upload_to_github() with values that
+# are already JSON encoded where they are not generated by this script
+PAYLOAD_TEMPLATE = ('{"station": %s, "nuke gone off?": "%s", "last monitor upload date": "%s", '
+                    '"nuke detected time": %s, "total minutes monitored": %d, "lat": %s, "long": %s}')
+STATION_JSON = json.dumps(secrets.STATION)
+LAT_JSON = json.dumps(secrets.LAT)
+LONG_JSON = json.dumps(secrets.LONG)
+
+# State of the data file from our last successful upload, so the next
+# upload can skip fetching it from GitHub
+_CACHED_SHA = None     # SHA of the file returned by the last PUT
+_CACHED_COUNT = 0      # "total minutes monitored" in the last upload
+_CACHED_STATUS = "no"  # "nuke gone off?" in the last upload
+_PENDING_MINUTES = 0   # Monitored minutes not yet uploaded
+_UPLOAD_FAILURES = 0   # Consecutive failed uploads, drives retry backoff
+_NEXT_UPLOAD_MS = 0   # ticks_ms() before which failed uploads are backed off
+_UPLOADING = False     # Set while an upload or ned_deferred() runs, guards re-entry
+_NED_TIME = None       # Timestamp of the latest nuclear event, reported by every upload
 
 #######################
 # Interrupt Handlers
@@ -48,38 +105,73 @@ def bist_interrupt_handler(pin):
     Args:
         pin: The pin that triggered the interrupt
     """
-    global BIST_ENABLED
-    BIST_ENABLED = True
+    _BIST_FLAG[0] = 1
 
 def ned_interrupt_handler(pin):
     """Nuclear Event Detection (NED) interrupt handler.
     
-    Triggered on falling edge of NED_OUT. Records event time and
-    initiates data upload to GitHub.
+    Triggered on rising edge of NED_OUT. Only latches the event flag and
+    tick count, then schedules ned_deferred() to timestamp and upload the
+    event outside interrupt context where heap allocation is allowed.
     
     Args:
         pin: The pin that triggered the interrupt
     """
-    global NED_EVENT
-    NED_OUT.irq(handler=None)  # Disable interrupts during handling
-    BIST_EN.irq(handler=None)
-    
-    NED_EVENT = 1  # Set nuclear event flag
-    LED_R.on()     # Visual indication of nuclear event
+    global NED_TICKS
+    _NED_FLAG[0] = 1             # Set nuclear event flag
+    NED_TICKS = time.ticks_ms()  # Record when the event fired
+    LED_R.on()                   # Visual indication of nuclear event
+    try:
+        micropython.schedule(ned_deferred, 0)
+    except RuntimeError:
+        pass  # Schedule queue full, the main loop will pick up the flag
+
+def ned_deferred(_):
+    """Record and upload a NED event latched by ned_interrupt_handler.
     
-    # Record and upload event data
-    ned_timestamp = get_timestamp()
-    upload_to_github(ned_timestamp)
-    print("NED event recorded and uploaded")
+    The flag is cleared before uploading so an event that re-fires while
+    the upload is in progress is not lost. Scheduled callbacks can run in
+    the middle of another upload, in which case the flag is left set for
+    the main loop to handle.
     
-    # Re-enable interrupts
-    NED_OUT.irq(trigger=machine.Pin.IRQ_RISING, handler=ned_interrupt_handler)
-    BIST_EN.irq(trigger=machine.Pin.IRQ_RISING, handler=bist_interrupt_handler)
+    Args:
+        _: Unused argument passed by micropython.schedule
+    """
+    global _NED_TIME, _UPLOADING
+    if _UPLOADING or not _NED_FLAG[0] or not upload_allowed():
+        return
+    # Hold the guard while taking the timestamp too, NTP polls and
+    # backoff sleeps also run scheduled callbacks
+    _UPLOADING = True
+    try:
+        new_event = _NED_FLAG[0] == 1
+        _NED_FLAG[0] = 0
+        if new_event or _NED_TIME is None:
+            _NED_TIME = get_timestamp(NED_TICKS)
+        if upload_to_github():
+            print("NED event recorded and uploaded")
+        elif not _NED_FLAG[0]:
+            _NED_FLAG[0] = 2  # Retry from the main loop
+    finally:
+        _UPLOADING = False
 
 #######################
 # Network Functions
 #######################
 
+def backoff_ms(attempt):
+    """Get retry delay using exponential backoff with full jitter.
+    
+    Args:
+        attempt: Number of previous failed attempts, starting at 0
+    
+    Returns:
+        int: Random delay in ms between 0 and
+        min(BACKOFF_CUTOFF, INITIAL_INTERVAL * 2**attempt)
+    """
+    window = min(BACKOFF_CUTOFF, INITIAL_INTERVAL << min(attempt, 8))
+    return urandom.getrandbits(16) % (window + 1)
+
 def connect_wifi(timeout=10):
     """Establish WiFi connection with timeout.
     
@@ -89,32 +181,48 @@ def connect_wifi(timeout=10):
     Returns:
         bool: True if connection successful, False otherwise
     """
-    start_time = time.time()
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.connect(secrets.SSID, secrets.PASSWORD)
+    start_ms = time.ticks_ms()
+    WLAN.active(True)
+    WLAN.connect(secrets.SSID, secrets.PASSWORD)
     
-    while not wlan.isconnected():
-        print("Connecting to Wi-Fi...")
-        # Visual connection attempt indication
-        for led in [LED_W, LED_R, LED_G]:
-            led.on()
-        time.sleep(0.5)
-        for led in [LED_W, LED_R, LED_G]:
-            led.off()
-        time.sleep(0.5)
-        
-        if time.time() - start_time > timeout:
+    print("Connecting to Wi-Fi...")
+    # Visual connection attempt indication, flashed by a timer so the
+    # connection state can be polled without blocking on the LEDs
+    for led in LEDS:
+        led.on()
+    blink_timer = machine.Timer(-1)
+    blink_timer.init(period=500, mode=machine.Timer.PERIODIC, callback=blink_leds)
+    
+    while not WLAN.isconnected():
+        if time.ticks_diff(time.ticks_ms(), start_ms) > timeout * 1000:
+            blink_timer.deinit()
             print("Failed to connect to Wi-Fi. Restarting...")
-            LED_R.on()  # Error indication
-            LED_G.off()
-            LED_W.off()
+            show_error_leds()
             machine.reset()
+        time.sleep_ms(50)
     
+    blink_timer.deinit()
     print("Connected to Wi-Fi")
+    LED_R.off()
+    LED_G.off()
     LED_W.on()  # Connection success indication
     return True
 
+def blink_leds(timer):
+    """Timer callback toggling all LEDs while connecting to Wi-Fi.
+    
+    Args:
+        timer: The timer that triggered the callback
+    """
+    for led in LEDS:
+        led.toggle()
+
+def show_error_leds():
+    """Light only the red LED to indicate a fatal error."""
+    for led in LEDS:
+        led.off()
+    LED_R.on()
+
 def get_ntp_time(retries=3):
     """Get current time from NTP server.
     
@@ -124,24 +232,37 @@ def get_ntp_time(retries=3):
     Returns:
         tuple: Time tuple (year, month, day, hour, minute, second, ...)
     """
+    global _NTP_ADDR
     NTP_DELTA = 2208988800
     for attempt in range(retries):
         try:
-            addr = socket.getaddrinfo(NTP_SERVER, 123)[0][-1]
+            # Resolve the server once and reuse the address
+            if _NTP_ADDR is None:
+                _NTP_ADDR = socket.getaddrinfo(NTP_SERVER, 123)[0][-1]
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(5)
             
-            ntp_query = b'\x1b' + 47 * b'\0'
-            sock.sendto(ntp_query, addr)
-            msg, _ = sock.recvfrom(48)
-            sock.close()
-
-            ntp_time = struct.unpack("!I", msg[40:44])[0] - NTP_DELTA
+            try:
+                # settimeout() is unreliable on some ports, so poll a
+                # non-blocking socket to bound the wait
+                sock.setblocking(False)
+                sock.sendto(_NTP_QUERY, _NTP_ADDR)
+                poller = select.poll()
+                poller.register(sock, select.POLLIN)
+                if not poller.poll(NTP_TIMEOUT):
+                    raise OSError("ntp timeout")
+                msg, _ = sock.recvfrom(48)
+            except OSError:
+                _NTP_ADDR = None  # Re-resolve on the next attempt
+                raise
+            finally:
+                sock.close()
+
+            ntp_time = struct.unpack_from("!I", msg, 40)[0] - NTP_DELTA
             return time.localtime(ntp_time)
             
         except Exception as e:
             print(f"Attempt {attempt + 1} failed to get network time: {e}")
-            time.sleep(2)
+            time.sleep_ms(backoff_ms(attempt))
     
     print("Failed to get network time after retries, using device time.")
     return time.localtime()
@@ -150,51 +271,79 @@ def get_ntp_time(retries=3):
 # GitHub Data Management
 #######################
 
-def upload_to_github(ned_time=None):
+def upload_allowed():
+    """Check whether the retry backoff after a failed upload has passed.
+    
+    Returns:
+        bool: True if an upload may be attempted now
+    """
+    # Only compare ticks while a failure is outstanding, ticks_diff() is
+    # meaningless once the stored tick is over half the wrap period old
+    return _UPLOAD_FAILURES == 0 or time.ticks_diff(time.ticks_ms(), _NEXT_UPLOAD_MS) >= 0
+
+def upload_failed():
+    """Count a failed upload and back off further uploads."""
+    global _CACHED_SHA, _UPLOAD_FAILURES, _NEXT_UPLOAD_MS
+    _CACHED_SHA = None  # Resync with GitHub on next upload
+    _NEXT_UPLOAD_MS = time.ticks_add(time.ticks_ms(), backoff_ms(_UPLOAD_FAILURES))
+    _UPLOAD_FAILURES += 1
+
+def upload_to_github():
     """Upload current status and event data to GitHub.
     
-    Args:
-        ned_time: Timestamp of nuclear event detection, if any
+    All pending monitored minutes are added to the uploaded total and
+    removed from the pending count once the upload succeeds. Once a
+    nuclear event is detected every upload reports it.
+    
+    Returns:
+        bool: True if upload successful, False otherwise
     """
-    global NED_EVENT
+    global _UPLOADING
+    # Restore rather than clear, ned_deferred() may already hold the guard
+    was_uploading = _UPLOADING
+    _UPLOADING = True
     try:
-        sha, existing_data = get_file_data()
+        return _upload_to_github()
+    finally:
+        _UPLOADING = was_uploading
 
-        # Update data from existing file 
-        total_count = existing_data.get("total minutes monitored", 0) + 1
-        nuke_status = existing_data.get("nuke gone off?", "no")
+def _upload_to_github():
+    """Body of upload_to_github(), run with the re-entry guard held."""
+    global _NED_TIME, _CACHED_SHA, _CACHED_COUNT, _CACHED_STATUS, _PENDING_MINUTES, _UPLOAD_FAILURES
+    minutes = _PENDING_MINUTES
+    try:
+        if _CACHED_SHA is not None:
+            # File unchanged since our last upload, no need to fetch it
+            sha = _CACHED_SHA
+            total_count = _CACHED_COUNT + minutes
+            nuke_status = _CACHED_STATUS
+        else:
+            sha, existing_data = get_file_data()
+            existing_data = existing_data or {}
+
+            # Update data from existing file 
+            total_count = existing_data.get("total minutes monitored", 0) + minutes
+            nuke_status = existing_data.get("nuke gone off?", "no")
+            # Keep an event recorded before a restart
+            if _NED_TIME is None:
+                _NED_TIME = existing_data.get("nuke detected time")
         
         # Update nuke status if event detected
-        if NED_EVENT == 1 or nuke_status == "yes":
+        ned_time = _NED_TIME
+        if ned_time is not None or nuke_status == "yes":
             nuke_status = "yes"
+        else:
+            nuke_status = "no"
 
         # Get current timestamp once to use in multiple places
         current_time = get_timestamp()
 
-        # Prepare new data payload
-        new_data = {
-            "station": secrets.STATION,
-            "nuke gone off?": nuke_status,
-            "last monitor upload date": current_time,
-            "nuke detected time": ned_time,
-            "total minutes monitored": total_count,
-            "lat": secrets.LAT,
-            "long": secrets.LONG
-        }
+        # Fill the fixed-schema JSON payload in a single substitution
+        json_string = PAYLOAD_TEMPLATE % (STATION_JSON, nuke_status, current_time,
+                                          json.dumps(ned_time), total_count, LAT_JSON, LONG_JSON)
 
-        # Convert JSON data to string and encode in base64 using ubinascii
-        json_string = json.dumps(new_data)
-        encoded_content = ubinascii.b2a_base64(json_string.encode()).decode().strip()
-
-        # GitHub API URL for uploading files
-        url = f"https://api.github.com/repos/{secrets.GITHUB_USER}/{secrets.REPO_NAME}/contents/{secrets.FILE_PATH}"
-
-        # Prepare headers for the GitHub API request
-        headers = {
-            "Authorization": f"token {secrets.GITHUB_TOKEN}",
-            "Content-Type": "application/json",
-            "User-Agent": f"BhangmeterV2.{secrets.STATION}"
-        }
+        # Encode in base64 using ubinascii, decoding only the final result
+        encoded_content = ubinascii.b2a_base64(json_string, newline=False).decode()
 
         # Prepare data for the GitHub API request
         data = {
@@ -208,20 +357,40 @@ def upload_to_github(ned_time=None):
             data["sha"] = sha
 
         # Send update to GitHub
-        response = urequests.request("PUT", url, headers=headers, data=json.dumps(data))
-        try:
-            if response.status_code in [200, 201]:
-                print("File uploaded successfully")
-            else:
-                print(f"Failed to upload file: {response.status_code}")
-        finally:
-            response.close()
+        status_code, body = github_request("PUT", PUT_HEADERS, json.dumps(data).encode())
+        if status_code in [200, 201]:
+            print("File uploaded successfully")
+            # The file is updated, so commit the counts before anything
+            # else can fail and have the minutes uploaded twice
+            _CACHED_COUNT = total_count
+            _CACHED_STATUS = nuke_status
+            # Subtract rather than zero, minutes may have been added
+            # while the upload was in progress
+            _PENDING_MINUTES -= minutes
+            _UPLOAD_FAILURES = 0
+            try:
+                _CACHED_SHA = json.loads(body)['content']['sha']
+            except Exception as e:
+                print(f"Error reading uploaded file SHA: {e}")
+                _CACHED_SHA = None  # Resync with GitHub on next upload
+            # Collect upload garbage now, outside any interrupt handler,
+            # to keep the heap unfragmented
+            gc.collect()
+            print("Free memory:", gc.mem_free())
+            return True
+        else:
+            print(f"Failed to upload file: {status_code}")
+            upload_failed()
+            return False
             
     except Exception as e:
         print(f"Error in upload_to_github: {e}")
+        upload_failed()
+        led_r_state = LED_R.value()  # RED may be showing a nuclear event
         LED_R.on()  # Error indication
         time.sleep(1)
-        LED_R.off()
+        LED_R.value(led_r_state)
+        return False
 
 def get_file_data():
     """Retrieve existing data file from GitHub.
@@ -229,18 +398,12 @@ def get_file_data():
     Returns:
         tuple: (sha, json_data) or (None, None) if file doesn't exist
     """
-    url = f"https://api.github.com/repos/{secrets.GITHUB_USER}/{secrets.REPO_NAME}/contents/{secrets.FILE_PATH}"
-    headers = {
-        "Authorization": f"token {secrets.GITHUB_TOKEN}",
-        "User-Agent": f"BhangmeterV2.{secrets.STATION}"
-    }
-
-    response = urequests.get(url, headers=headers)
-    print("Response Status Code:", response.status_code)
+    status_code, body = github_request("GET", GET_HEADERS)
+    print("Response Status Code:", status_code)
 
     try:
-        if response.status_code == 200:
-            file_data = response.json()
+        if status_code == 200:
+            file_data = json.loads(body)
             sha = file_data['sha']
             encoded_content = file_data['content']
             
@@ -249,28 +412,106 @@ def get_file_data():
             json_data = json.loads(decoded_content)
             return sha, json_data
             
-        elif response.status_code == 404:
+        elif status_code == 404:
             print(f"File does not exist, creating new: {secrets.FILE_PATH}")
             return None, None
             
         else:
-            print(f"Failed to check file: {response.status_code}")
+            print(f"Failed to check file: {status_code}")
             return None, None
             
     except ValueError as e:
         print(f"Error parsing JSON response: {e}")
         return None, None
-        
+
+def github_request(method, headers, body=None, timeout_ms=HTTP_TIMEOUT):
+    """Send an HTTPS request for the data file to the GitHub API.
+    
+    urequests can block for ~30 s in socket.connect() when the network
+    drops, so the connection is opened non-blocking and polled to bound
+    the wait, then the request is sent by hand over TLS.
+    
+    Args:
+        method: HTTP method, e.g. "GET" or "PUT"
+        headers: Dict of request headers
+        body: Request body bytes, if any
+        timeout_ms: Maximum time to wait to connect and for each read
+    
+    Returns:
+        tuple: (status_code, body) with body as bytes
+    
+    Raises:
+        OSError: On connection failure or timeout
+    """
+    global _GITHUB_ADDR
+    # Resolve the host once and reuse the address
+    if _GITHUB_ADDR is None:
+        _GITHUB_ADDR = socket.getaddrinfo(GITHUB_HOST, 443, 0, socket.SOCK_STREAM)[0][-1]
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        try:
+            sock.connect(_GITHUB_ADDR)
+        except OSError as e:
+            if e.errno != errno.EINPROGRESS:
+                _GITHUB_ADDR = None  # Re-resolve on the next request
+                raise
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        events = poller.poll(timeout_ms)
+        if not events:
+            _GITHUB_ADDR = None
+            raise OSError("connect timeout")
+        if events[0][1] & (select.POLLERR | select.POLLHUP):
+            _GITHUB_ADDR = None
+            raise OSError("connect failed")
+        sock.settimeout(timeout_ms / 1000)
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.verify_mode = ssl.CERT_NONE
+        sock = context.wrap_socket(sock, server_hostname=GITHUB_HOST)
+
+        # HTTP/1.0 so the server closes the connection after the body
+        sock.write(method)
+        sock.write(" ")
+        sock.write(GITHUB_PATH)
+        sock.write(" HTTP/1.0\r\nHost: ")
+        sock.write(GITHUB_HOST)
+        sock.write("\r\n")
+        for name, value in headers.items():
+            sock.write(name)
+            sock.write(": ")
+            sock.write(value)
+            sock.write("\r\n")
+        if body:
+            sock.write(f"Content-Length: {len(body)}\r\n\r\n")
+            sock.write(body)
+        else:
+            sock.write("\r\n")
+
+        # Status line, then skip headers up to the blank line
+        status_code = int(sock.readline().split(None, 2)[1])
+        while sock.readline() not in (b"\r\n", b""):
+            pass
+        return status_code, sock.read()
     finally:
-        response.close()
+        sock.close()
 
-def get_timestamp():
+def get_timestamp(since_ticks=None):
     """Get formatted timestamp string.
     
+    Args:
+        since_ticks: ticks_ms() value to back-date the timestamp to, if any
+    
     Returns:
         str: Formatted timestamp (YYYY-MM-DD HH:MM:SS)
     """
     tm = get_ntp_time()
+    if since_ticks is not None:
+        # Remove the time spent between the tick and the NTP reply
+        elapsed_s = time.ticks_diff(time.ticks_ms(), since_ticks) // 1000
+        tm = time.localtime(time.mktime(tm) - elapsed_s)
     return f"{tm[0]}-{tm[1]:02d}-{tm[2]:02d} {tm[3]:02d}:{tm[4]:02d}:{tm[5]:02d}"
 
 #######################
@@ -280,13 +521,12 @@ def get_timestamp():
 def main():
     """Main program loop."""
     # Initialize LED states
-    LED_W.off()
-    LED_R.off()
-    LED_G.off()
+    for led in LEDS:
+        led.off()
     BIST_OUT.on() 
     retry_count = 0
     max_retries = 3
-    global BIST_ENABLED
+    global _PENDING_MINUTES
     print("NED_OUT: ", NED_OUT.value())
     # Main program loop with retry mechanism
     while retry_count < max_retries:
@@ -294,41 +534,55 @@ def main():
             if connect_wifi():
                 LED_W.on()  # Connected to WiFi
                 # Initialize interrupt handlers
-                BIST_EN.irq(trigger=machine.Pin.IRQ_RISING, handler=bist_interrupt_handler)
-                NED_OUT.irq(trigger=machine.Pin.IRQ_RISING, handler=ned_interrupt_handler)
-                last_upload_time = time.time() - 60  # Force immediate upload on first run
+                # Soft IRQs so a handler cannot hit a locked heap
+                BIST_EN.irq(trigger=machine.Pin.IRQ_RISING, handler=bist_interrupt_handler, hard=False)
+                NED_OUT.irq(trigger=machine.Pin.IRQ_RISING, handler=ned_interrupt_handler, hard=False)
+                last_upload_ms = time.ticks_add(time.ticks_ms(), -60000)  # Force immediate upload on first run
                 while True:
                     try:
                         # Check for BIST flag
-                        if BIST_ENABLED:
-                            NED_OUT.irq(handler=None)
+                        if _BIST_FLAG[0]:
+                            _BIST_FLAG[0] = 0  # Reset flag
                             print("in")
                             # Run BIST sequence (all logic moved from handler)
-                            start_time = time.time()
-                            #print("NED_OUT: ", NED_OUT.value())
-                            BIST_OUT.off()  # Start BIST sequence
-                            BIST_OUT.on()   # Only short pulse is required to activate NED BIST
-                            #print("NED_OUT: ", NED_OUT.value())
-                            # Wait up to 1 second for NED_OUT response
-                            while time.time() - start_time < 1:
-                                if NED_OUT.value() == 1:
-                                    print("BIST Passed")
-                                    LED_G.on()  # Visual indication of BIST success
-                                    time.sleep(2)
-                                    LED_G.off()
-                                    LED_R.off() # Also turn off RED as manual reset of proper NED event.
-                                    break
-
-                            BIST_OUT.on()  # Reset BIST output
-                            
-                            BIST_ENABLED = False  # Reset flag
+                            # Mask the NED IRQ only while the test pulse can
+                            # be seen, so the BIST is not recorded as an event
+                            NED_OUT.irq(handler=None)
+                            try:
+                                #print("NED_OUT: ", NED_OUT.value())
+                                BIST_OUT.off()  # Start BIST sequence
+                                BIST_OUT.on()   # Only short pulse is required to activate NED BIST
+                                # Wait up to 1 second for NED_OUT to go high, -2 means it never did
+                                pulse = machine.time_pulse_us(NED_OUT, 1, 1_000_000)
+                            finally:
+                                BIST_OUT.on()
+                                NED_OUT.irq(trigger=machine.Pin.IRQ_RISING, handler=ned_interrupt_handler, hard=False)
+                            if pulse != -2:
+                                print("BIST Passed")
+                                LED_G.on()  # Visual indication of BIST success
+                                time.sleep(2)
+                                LED_G.off()
+                                LED_R.off() # Also turn off RED as manual reset of proper NED event.
+
+                            gc.collect()
+                        
+                        # Upload NED event if it could not be scheduled
+                        if _NED_FLAG[0]:
+                            ned_deferred(0)
                         
-                        # Timer-based upload
-                        current_time = time.time()
-                        if current_time - last_upload_time >= 60:
-                            upload_to_github()
-                            last_upload_time = current_time
-                        time.sleep(0.1)  # Short sleep for responsiveness
+                        # Count monitored minutes, upload every FLUSH_EVERY
+                        # minutes or straight away if not yet synced
+                        now_ms = time.ticks_ms()
+                        if time.ticks_diff(now_ms, last_upload_ms) >= 60000:
+                            _PENDING_MINUTES += 1
+                            last_upload_ms = now_ms
+                            if (_PENDING_MINUTES >= FLUSH_EVERY or _CACHED_SHA is None) and upload_allowed():
+                                upload_to_github()
+                        
+                        # Sleep until the next minute tick, BIST and NED pin
+                        # interrupts wake the CPU early
+                        sleep_ms = max(0, 60000 - time.ticks_diff(time.ticks_ms(), last_upload_ms))
+                        machine.lightsleep(min(1000, sleep_ms))
                     except Exception as e:
                         print(f"Error in main loop: {e}")
                         time.sleep(5)  # Brief delay before retry
@@ -342,9 +596,7 @@ def main():
     
     # Reset device if max retries exceeded
     print("Maximum retries reached, resetting device...")
-    LED_R.on()  # Error indication
-    LED_G.off()
-    LED_W.off()
+    show_error_leds()
     machine.reset()
 
 
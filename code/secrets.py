@@ -4,5 +4,6 @@ FILE_PATH = "events.json"
 GITHUB_TOKEN = "SECRET_TOKEN"
 SSID = "SSID_HERE"
 PASSWORD = "PASSWORD_HERE"
+STATION = "STATION_NAME"
 LAT = 51.46
 LONG = -0.65